@@ -2,12 +2,19 @@
 """
 Multiple EV cohorts, limited hours of (dis)charge, able to influence price
 
-To install all dependencies with conda, run "conda install numpy && conda install -c conda-forge pyomo ipopt=3.11.1"
+To install all dependencies with conda, run
+"conda install numpy && conda install -c conda-forge pyomo ipopt=3.11.1 highspy"
 """
 
 __author__ = "Zachary Weiss"
 
+import functools
+import os
+import re
+import sys
+
 import pyomo.environ as pyo
+from pyomo.core.expr.numeric_expr import LinearExpression
 import numpy as np
 
 # global settings
@@ -27,69 +34,147 @@ EV_CONFIG = [{"S_0": 0, "S_max": 5, "R_max": 1, "H": range(7), "P": 0.5},
 def main():
     notes()
 
+    model = build_model(price_signal(N_HOURS, 17, 26))
+    solve(model)
+    # full model dump for debugging, off by default as it can dwarf the solve itself
+    if os.environ.get("DS_VERBOSE"):
+        model.pprint()
+
+    readout(model)
+
+
+def build_model(base_prices):
+    """construct the scheduling model for EV_CONFIG. Base prices and price influence coefficients are mutable params,
+    so a sweep can update them in place (see update_base_prices / update_P_coef) and re-solve without reconstruction"""
     model = pyo.ConcreteModel()
 
-    # price signal: array of prices at each hour [$/kWh], peak value at 6pm
-    # base_prices = np.random.rand(N_HOURS) * 10
-    base_prices = 5 * gaussian(np.linspace(0, N_HOURS - 1, N_HOURS), 17, 26) + 5
+    # first and last hour each EV is online, found once per cohort and reused by the checks and constraints below
+    H_min = np.array([min(ev["H"]) for ev in EV_CONFIG])
+    H_max = np.array([max(ev["H"]) for ev in EV_CONFIG])
 
     # check valid hour configuration (no online hours specified beyond N_HOURS)
-    for ev in EV_CONFIG:
-        if max(ev["H"]) >= N_HOURS or min(ev["H"]) < 0:
-            raise SystemExit("Hours specified for EV (dis)charge must be between zero and N_HOURS. Modify the EV "
-                             "config and rerun.")
+    if H_max.max() >= N_HOURS or H_min.min() < 0:
+        raise SystemExit("Hours specified for EV (dis)charge must be between zero and N_HOURS. Modify the EV config "
+                         "and rerun.")
+
+    # per-cohort parameters as arrays indexed by EV number, and a boolean mask of which hours each EV is online
+    H_mask = availability_mask(EV_CONFIG, N_HOURS)
+    price_independent = all(ev["P"] == 0 for ev in EV_CONFIG)
+    Smax = np.array([ev["S_max"] for ev in EV_CONFIG], dtype=float)
+    Rmax = np.array([ev["R_max"] for ev in EV_CONFIG], dtype=float)
 
     # index
     hours = range(N_HOURS)
-    model.i = pyo.Set(initialize=[i for i, ev in enumerate(EV_CONFIG)])
-    model.t = pyo.Set(initialize=hours)
-    model.t_1 = pyo.Set(initialize=range(N_HOURS + 1))
-
-    def ij_init(m):
-        # key pairs for S and R matrices w/i pyomo
-        # i is the EV number, j is the hour (t)
-        return ((i, j) for i in m.i for j in m.t)
-
-    # same as above, but initializes for one extra hour to be compatible with the update rule
-    def ij_init_1(m):
-        return ((i, j) for i in m.i for j in m.t_1)
-
-    # decision vars
-    model.S = pyo.Var(pyo.Set(dimen=2, initialize=ij_init_1), within=pyo.NonNegativeReals)
-    model.R = pyo.Var(pyo.Set(dimen=2, initialize=ij_init), within=pyo.Reals)
-    model.P = pyo.Var(hours, within=pyo.NonNegativeReals)
-
-    # objective function
-    cost = sum(sum(model.P[t] * model.R[i, t] for t in hours) for i, ev in enumerate(EV_CONFIG))
+    model.i = pyo.RangeSet(0, len(EV_CONFIG) - 1)
+    model.t = pyo.RangeSet(0, N_HOURS - 1)
+    model.t_1 = pyo.RangeSet(0, N_HOURS)
+
+    # whether the price influence is substituted out altogether, leaving an LP
+    model.price_independent = price_independent
+
+    # params
+    model.base_price = pyo.Param(model.t, initialize=lambda m, t: float(base_prices[t]), mutable=True)
+    model.P_coef = pyo.Param(model.i, initialize=lambda m, i: float(EV_CONFIG[i]["P"]), mutable=True)
+
+    # decision vars, indexed by EV number i and hour t (S over one extra hour to be compatible with the update rule).
+    # stored energy is between 0 and the maximum for each EV cohort, rate is bounded by the symmetric max. If the EV is
+    # not able to (dis)charge during the current hour the rate is pinned to zero through its bounds, which the solver's
+    # presolve removes outright rather than carrying an extra equality row
+    def R_bounds(m, i, t):
+        return (-Rmax[i], Rmax[i]) if H_mask[i, t] else (0, 0)
+    model.S = pyo.Var(model.i, model.t_1, within=pyo.NonNegativeReals, bounds=lambda m, i, t: (0, Smax[i]))
+    model.R = pyo.Var(model.i, model.t, within=pyo.Reals, bounds=R_bounds)
+
+    # price at each hour is sum of base price and amount of price increase from the load scheduled. Substituted directly
+    # into the objective and constraints rather than carried as a separate variable, leaving a QP purely in R (or an LP
+    # when every P is zero, in which case the price is just the base price). Both the price and the total load are built
+    # as LinearExpressions straight from coefficient / variable lists, skipping the nested sum expression trees that
+    # python's sum() would assemble
+    if price_independent:
+        # objective function, a single linear expression over every rate as the price does not depend on them
+        cost = LinearExpression(constant=0., linear_coefs=[model.base_price[t] for i in model.i for t in hours],
+                                linear_vars=[model.R[i, t] for i in model.i for t in hours])
+    else:
+        price = {t: LinearExpression(constant=model.base_price[t], linear_coefs=[model.P_coef[i] for i in model.i],
+                                     linear_vars=[model.R[i, t] for i in model.i]) for t in hours}
+        load = {t: LinearExpression(constant=0., linear_coefs=[1.] * len(model.i),
+                                    linear_vars=[model.R[i, t] for i in model.i]) for t in hours}
+        # objective function
+        cost = sum(price[t] * load[t] for t in hours)
     model.cost = pyo.Objective(expr=cost, sense=pyo.minimize)
 
-    # constraints
-    model.cons = pyo.ConstraintList()
-    for i, ev in enumerate(EV_CONFIG):
-        # boundary condition: storage begins at initial value
-        model.cons.add(model.S[i, 0] == ev["S_0"])
-        # boundary condition: after final schedule-able hour, storage must equal maximum charge
-        model.cons.add(model.S[i, max(ev["H"]) + 1] == ev["S_max"])
-
-    # constraints applied each hour (bounds already handled in pyomo variable declaration)
-    for t in hours:
-        for i, ev in enumerate(EV_CONFIG):
-            # if the EV is not able to (dis)charge during the current hour, the rate must be zero. Else, bounded by max
-            # and min (now added as constraint as cannot be easily added in variable bounds at time of declaration)
-            if t not in ev["H"]:
-                model.cons.add(model.R[i, t] == 0)
-            else:
-                model.cons.add(pyo.inequality(-ev["R_max"], model.R[i, t], ev["R_max"]))
-            # stored energy must be between 0 and the maximum for each EV cohort
-            model.cons.add(pyo.inequality(0, model.S[i, t], ev["S_max"]))
-            # update rule, storage at next time point is current storage plus amount charged for each EV cohort
-            model.cons.add(model.S[i, t + 1] == model.S[i, t] + model.R[i, t])
-        # price at each hour is sum of base price and amount of price increase from the load scheduled
-        model.cons.add(model.P[t] == base_prices[t] + sum([ev["P"] * model.R[i, t] for i, ev in enumerate(EV_CONFIG)]))
-
-    results = pyo.SolverFactory('multistart').solve(model, suppress_unbounded_warning=True)
-
-    readout(model, base_prices)
+    # constraints, each declared as an indexed component so pyomo generates all of its rows in one pass rather than
+    # through repeated ConstraintList.add() calls
+    # boundary condition: storage begins at initial value
+    def boundary_S0_rule(m, i):
+        return m.S[i, 0] == EV_CONFIG[i]["S_0"]
+    model.boundary_S0 = pyo.Constraint(model.i, rule=boundary_S0_rule)
+
+    # boundary condition: after final schedule-able hour, storage must equal maximum charge
+    def boundary_Smax_rule(m, i):
+        return m.S[i, H_max[i] + 1] == Smax[i]
+    model.boundary_Smax = pyo.Constraint(model.i, rule=boundary_Smax_rule)
+
+    # update rule, storage at next time point is current storage plus amount charged for each EV cohort
+    def update_rule(m, i, t):
+        return m.S[i, t + 1] == m.S[i, t] + m.R[i, t]
+    model.update_con = pyo.Constraint(model.i, model.t, rule=update_rule)
+
+    # clearing price can not go negative (nothing to constrain when it is just the base price)
+    def price_rule(m, t):
+        return pyo.Constraint.Skip if price_independent else price[t] >= 0
+    model.price_con = pyo.Constraint(model.t, rule=price_rule)
+
+    return model
+
+
+def choose_solver(price_independent, P_coefs):
+    """name of the pyomo solver suited to the model structure and the cohorts' price influence coefficients"""
+    # price independent of demand: the objective is linear, an LP for HiGHS simplex. appsi_highs is persistent, so
+    # re-solves of the same model (see sweep) start from the previous basis
+    if price_independent:
+        return 'appsi_highs'
+    # every cohort sharing the same nonnegative P: a convex QP, whose global optimum a single interior point solve
+    # returns. This includes a model built with demand dependent price whose P have since all been updated to zero, as
+    # its objective keeps the quadratic structure
+    P_coefs = set(P_coefs)
+    if len(P_coefs) == 1 and min(P_coefs) >= 0:
+        return 'ipopt'
+    # differing P can make the QP nonconvex, fall back to the multistart meta-solver
+    return 'multistart'
+
+
+def solve(model):
+    name = choose_solver(model.price_independent, var_values(model.P_coef))
+    if name == 'multistart':
+        return get_solver(name).solve(model, suppress_unbounded_warning=True)
+    return get_solver(name).solve(model)
+
+
+def update_base_prices(model, base_prices):
+    """set new base prices [$/kWh] for every hour of an already built model"""
+    for t in model.t:
+        model.base_price[t] = float(base_prices[t])
+
+
+def update_P_coef(model, i, P):
+    """set a new price influence coefficient [$/kWh^2] for EV cohort i of an already built model"""
+    # models built with every P at zero have the price influence substituted out of their objective altogether
+    if P != 0 and model.price_independent:
+        raise ValueError("Price influence coefficients of a model built with every P equal to zero can not be updated. "
+                         "Rebuild the model instead.")
+    model.P_coef[i] = float(P)
+
+
+def sweep(base_prices_profiles):
+    """solve the EV_CONFIG schedule against each base price profile in turn, yielding (cost, R_sol) for each. The model
+    is built once and only its params updated between solves; the variables keep the previous optimum, which the solver
+    then starts from"""
+    model = build_model(base_prices_profiles[0])
+    for base_prices in base_prices_profiles:
+        update_base_prices(model, base_prices)
+        solve(model)
+        yield model.cost(), var_values(model.R, np.float32).reshape(len(EV_CONFIG), N_HOURS)
 
 
 def lrange(*args):
@@ -97,14 +182,41 @@ def lrange(*args):
     return list(range(*args))
 
 
+@functools.lru_cache(maxsize=None)
+def get_solver(name):
+    """solver instance by pyomo name, created once per process so repeated solves skip the executable search"""
+    return pyo.SolverFactory(name)
+
+
+def availability_mask(ev_config, n_hours):
+    """boolean array of shape (len(ev_config), n_hours), True where the EV cohort is online and able to (dis)charge"""
+    H_mask = np.zeros((len(ev_config), n_hours), dtype=bool)
+    for i, ev in enumerate(ev_config):
+        H_mask[i, list(ev["H"])] = True
+    return H_mask
+
+
 def gaussian(x, mu, sig):
-    return np.exp(-np.power(x - mu, 2.) / (2 * np.power(sig, 2.)))
+    d = x - mu
+    return np.exp(-(d * d) * (0.5 / (sig * sig)))
+
+
+@functools.lru_cache(maxsize=None)
+def price_signal(n_hours, mu, sig):
+    """price signal: array of prices at each hour [$/kWh], peak value at hour 'mu'. Cached so repeated runs (e.g.
+    parameter sweeps) reuse the same read-only array rather than recomputing it"""
+    # base_prices = np.random.rand(n_hours) * 10
+    base_prices = 5 * gaussian(np.linspace(0, n_hours - 1, n_hours), mu, sig) + 5
+    base_prices.flags.writeable = False
+    return base_prices
 
 
 def notes():
-    print("""\n\033[1mKey and Notes\033[0m
-\033[3mDependencies\033[0m: pyomo, numpy, ipopt, and multistart (NLP solver, should come pre-installed with pyomo)
-If not fully installed, run "conda install numpy && conda install -c conda-forge pyomo ipopt=3.11.1" without quotes.
+    emit("""\n\033[1mKey and Notes\033[0m
+\033[3mDependencies\033[0m: pyomo, numpy, ipopt, highspy (LP solver, when every P is zero), and multistart (NLP solver,
+should come pre-installed with pyomo)
+If not fully installed, run "conda install numpy && conda install -c conda-forge pyomo ipopt=3.11.1 highspy" without 
+quotes.
 \033[3mS\033[0m -> stored energy [kWh]
 \033[3mR\033[0m -> charge rate [kW] (as everywhere referenced the rate is applied over an hour\u2014implied "*1hr" after each instance\u2014
      it is effectively in units of kWh)
@@ -116,53 +228,82 @@ during that hour, whereas the EV cohort is offline for all entries in the defaul
 configurations, edit the EV_CONFIG variable at the top of this file and re-run, following the example entry format for 
 each new EV cohort, separated by commas. If tables appear weird, expand your window horizontally or disable text wrapping.""")
 
-    print("\n\033[1mEV Cohort Configuration\033[0m")
+    emit("\n\033[1mEV Cohort Configuration\033[0m")
     for i, ev in enumerate(EV_CONFIG):
-        print("\033[3m{:<12s}\033[0m".format(f"EV #{i}") + "".join("{:<25s}".format(f"\033[3m{k}\033[0m: {ev[k]}") for k
-                                                                   in ev))
+        emit("\033[3m{:<12s}\033[0m".format(f"EV #{i}") + "".join("{:<25s}".format(f"\033[3m{k}\033[0m: {ev[k]}") for k
+                                                                  in ev))
+
+
+_ANSI = re.compile(r"\033\[[0-9;]*m")
+# whether stdout is a terminal, checked once rather than for every line printed
+_STYLED = sys.stdout.isatty()
+
+
+def emit(text=""):
+    """print, dropping the ANSI styling when stdout is not a terminal (e.g. redirected to a file or piped)"""
+    print(text if _STYLED else _ANSI.sub("", text))
 
 
-def readout(model, base_prices):
-    S_sol = np.array([v.value for i, v in model.S.items()]).reshape(len(EV_CONFIG), N_HOURS + 1)
-    R_sol = np.array([v.value for i, v in model.R.items()]).reshape(len(EV_CONFIG), N_HOURS)
-    P_sol = np.array([v.value for i, v in model.P.items()])
+def var_values(var, dtype=np.float64):
+    """solved values of an indexed pyomo variable (or mutable param) as a flat array, in index order, streamed straight
+    into a single preallocated numpy buffer"""
+    return np.fromiter((v.value for v in var.values()), dtype=dtype, count=len(var))
 
-    costs = np.array([np.array(ev_R * P_sol) for ev_R in R_sol])
-    ev_tot_cost = costs.sum(axis=1)
+
+def readout(model):
+    # post-processing only, so downcast to single precision: ample for prices meaningful to ~1e-3 $/kWh, and halves
+    # memory traffic over large sweeps (the solver itself works in double)
+    base_prices = var_values(model.base_price, np.float32)
+    S_sol = var_values(model.S, np.float32).reshape(len(EV_CONFIG), N_HOURS + 1)
+    R_sol = var_values(model.R, np.float32).reshape(len(EV_CONFIG), N_HOURS)
+    P_sol = base_prices + var_values(model.P_coef, np.float32) @ R_sol
+
+    # total cost per cohort is sum over hours of rate * clearing price, a single matrix-vector product
+    ev_tot_cost = R_sol @ P_sol
     ev_avg_price = ev_tot_cost / R_sol.sum(axis=1)
 
+    # raw solution arrays for downstream tooling, written when an output path is given
+    if os.environ.get("DS_OUTPUT"):
+        np.savez(os.environ["DS_OUTPUT"], S_sol=S_sol, R_sol=R_sol, P_sol=P_sol, base_prices=base_prices,
+                 cost=model.cost())
+
+    # hours each EV is online, padded with offline columns to the width of the widest table (S has N_HOURS + 1 columns)
+    H_mask = np.pad(availability_mask(EV_CONFIG, N_HOURS), ((0, 0), (0, 1)))
+
     def pretty_print(arr):
         # zero out floating point errors within tolerance
         tol = 1e-16
-        arr[(arr < tol) & (-tol < arr)] = 0
+        arr = np.where(np.abs(arr) < tol, 0., arr)
 
         def trimmer(n):
             return np.format_float_positional(n, 2, trim="-")
 
+        # color codes for every cell resolved in one vectorized pass: green / red for charge / discharge while online
+        colors = np.where(H_mask[:, :arr.shape[1]], np.where(arr >= 0, '\033[92m', '\033[91m'), '')
+        resets = np.where(colors != '', '\033[0m', '')
+
         for i, row in enumerate(arr):
-            num_str = ''.join(
-                (f'\033[92m{trimmer(val): >7s}\033[0m' if val >= 0 else f'\033[91m{trimmer(val): >7s}\033[0m')
-                if t in EV_CONFIG[i]["H"] else f'{trimmer(val): >7s}' for t, val in enumerate(row))
-            print("\033[3m{:<6s}\033[0m{}".format(f"EV #{i}", num_str))
+            num_str = ''.join(f'{c}{trimmer(val): >7s}{r}' for c, val, r in zip(colors[i], row, resets[i]))
+            emit("\033[3m{:<6s}\033[0m{}".format(f"EV #{i}", num_str))
 
-    print("\n\033[1mStorage values by hour [kWh]\033[0m")
+    emit("\n\033[1mStorage values by hour [kWh]\033[0m")
     hour_arr = np.append(np.add(lrange(N_HOURS), 1), "S_final")
-    print("\033[3m{:<9s}".format("Hour") + ''.join("{:^7s}".format(hr) for hr in hour_arr) + "\033[0m")
+    emit("\033[3m{:<9s}".format("Hour") + ''.join("{:^7s}".format(hr) for hr in hour_arr) + "\033[0m")
     pretty_print(S_sol)
 
-    print("\n\033[1mCharging rates by hour [kW]\033[0m")
+    emit("\n\033[1mCharging rates by hour [kW]\033[0m")
     pretty_print(R_sol)
 
-    print("\n\033[1mBase and adjusted clearing price (after additional EV load) by hour [$/kWh]\033[0m")
-    print("\033[3m{:<6s}\033[0m".format("Π") + "".join(f"{item: >7.2f}" for item in base_prices))
-    print("\033[3m{:<6s}\033[0m".format("Π_adj") + "".join(f"{item: >7.2f}" for item in P_sol))
+    emit("\n\033[1mBase and adjusted clearing price (after additional EV load) by hour [$/kWh]\033[0m")
+    emit("\033[3m{:<6s}\033[0m".format("Π") + "".join(f"{item: >7.2f}" for item in base_prices))
+    emit("\033[3m{:<6s}\033[0m".format("Π_adj") + "".join(f"{item: >7.2f}" for item in P_sol))
 
-    print("\n\033[1mTotal cost by EV cohort\033[0m")
+    emit("\n\033[1mTotal cost by EV cohort\033[0m")
     for i, ev in enumerate(EV_CONFIG):
-        print("\033[3m{:<8s}\033[0m{:>8s}    {}".format(f"EV #{i}", f"${ev_tot_cost[i]:.2f}", "(average "
-              f"of ${ev_avg_price[i]:.2f} per unit of energy)"))
-    print(f"\033[3mOverall\033[0m  ${model.cost():.2f}    (average of ${model.cost() / sum(sum(R_sol)):.2f} per unit "
-          f"of energy)")
+        emit("\033[3m{:<8s}\033[0m{:>8s}    {}".format(f"EV #{i}", f"${ev_tot_cost[i]:.2f}", "(average "
+             f"of ${ev_avg_price[i]:.2f} per unit of energy)"))
+    emit(f"\033[3mOverall\033[0m  ${model.cost():.2f}    (average of ${model.cost() / sum(sum(R_sol)):.2f} per unit "
+         f"of energy)")
 
 
 if __name__ == '__main__':
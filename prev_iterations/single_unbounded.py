@@ -26,8 +26,12 @@ Assumes symmetric maximum charge and discharge rates
 
 __author__ = "Zachary Weiss"
 
+import os
+
 import pyomo.environ as pyo
 import numpy as np
+from scipy import sparse
+from scipy.optimize import linprog
 
 # global settings
 N_HOURS = 24
@@ -41,18 +45,29 @@ base_prices = np.random.rand(N_HOURS) * 10
 
 
 def main():
-    model = pyo.ConcreteModel()
-
     # index
     hours = range(N_HOURS)
 
+    # with P=0 the price is independent of demand and the problem is a plain LP, solved directly without pyomo
+    if EV_CONFIG["P"] == 0:
+        cost, R_sol = solve_lp([(-EV_CONFIG["R_max"], EV_CONFIG["R_max"])] * N_HOURS)
+        print(f"cost: {cost:.2f}")
+        print("R:", np.round(R_sol, 2))
+        return
+
+    model = pyo.ConcreteModel()
+
     # decision vars
     model.S = pyo.Var(range(N_HOURS+1), bounds=(0, EV_CONFIG["S_max"]), within=pyo.NonNegativeReals)
     model.R = pyo.Var(hours, bounds=(-EV_CONFIG["R_max"], EV_CONFIG["R_max"]), within=pyo.Reals)
-    model.P = pyo.Var(hours, within=pyo.NonNegativeReals)
+
+    # price at each hour is sum of base price and amount of price increase from the load scheduled, substituted into the
+    # objective so it is a QP purely in R
+    def price(m, t):
+        return base_prices[t] + (EV_CONFIG["P"] * m.R[t])
 
     # objective function
-    cost = sum(model.P[t] * model.R[t] for t in hours)
+    cost = sum(price(model, t) * model.R[t] for t in hours)
     model.cost = pyo.Objective(expr=cost, sense=pyo.minimize)
 
     # constraints
@@ -63,21 +78,48 @@ def main():
     model.cons.add(model.S[0] == EV_CONFIG["S_0"])
 
     # constraints applied each hour (bounds already handled in pyomo variable declaration)
-    for t in hours:
-        # update rule, storage at next time point is current storage plus amount charged
-        model.cons.add(model.S[t+1] == model.S[t] + model.R[t])
-        # price at each hour is sum of base price and amount of price increase from the load scheduled
-        model.cons.add(model.P[t] == base_prices[t] + (EV_CONFIG["P"] * model.R[t]))
+    # update rule, storage at next time point is current storage plus amount charged
+    model.update_con = pyo.Constraint(hours, rule=lambda m, t: m.S[t+1] == m.S[t] + m.R[t])
+    # clearing price can not go negative
+    model.price_con = pyo.Constraint(hours, rule=lambda m, t: price(m, t) >= 0)
 
     # cbc, glpk, gurobi, cplex, pico, scip, xpress: LP/MIP solvers
     # conopt, cyipopt, ipopt: NLP
     # path: MCP
     # more can be found via "pyomo help --solvers"
-    results = pyo.SolverFactory('multistart').solve(model, suppress_unbounded_warning=True)
-
-    # display results
-    model.display()
-    print("done")
+    # objective is a convex QP for P > 0, so one interior point solve suffices (P=0 was already solved as an LP above).
+    # Negative P makes it concave, where a single local solve is not enough, so fall back to the multistart meta-solver
+    if EV_CONFIG["P"] > 0:
+        results = pyo.SolverFactory('ipopt').solve(model)
+    else:
+        results = pyo.SolverFactory('multistart').solve(model, suppress_unbounded_warning=True)
+
+    # display results, with the full model dump only on request as it can dwarf the solve itself
+    if os.environ.get("DS_VERBOSE"):
+        model.display()
+        print("done")
+    else:
+        print(f"cost: {model.cost():.2f}")
+        print("R:", np.round([model.R[t].value for t in hours], 2))
+
+
+def solve_lp(R_bounds):
+    """solve the P=0 case (price independent of demand) as a plain LP with scipy's HiGHS dual simplex, needing neither
+    a pyomo model nor an external solver executable. Decision vector is [R_0..R_{N-1}, S_0..S_N]"""
+    n = N_HOURS
+    # update rule S[t+1] - S[t] - R[t] == 0 as -I over R beside a bidiagonal block over S, then the two boundary rows
+    # fixing S[0] and S[N_HOURS]
+    A_update = sparse.hstack([-sparse.eye(n), sparse.eye(n, n + 1, k=1) - sparse.eye(n, n + 1)])
+    A_boundary = sparse.csr_matrix(([1., 1.], ([0, 1], [n, 2 * n])), shape=(2, 2 * n + 1))
+    A_eq = sparse.vstack([A_update, A_boundary], format="csr")
+    b_eq = np.concatenate([np.zeros(n), [EV_CONFIG["S_0"], EV_CONFIG["S_max"]]])
+
+    c = np.concatenate([base_prices, np.zeros(n + 1)])
+    bounds = list(R_bounds) + [(0, EV_CONFIG["S_max"])] * (n + 1)
+    res = linprog(c, A_eq=A_eq, b_eq=b_eq, bounds=bounds, method="highs-ds")
+    if not res.success:
+        raise SystemExit(f"LP solve failed: {res.message}")
+    return res.fun, res.x[:n]
 
 
 if __name__ == '__main__':